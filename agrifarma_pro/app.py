@@ -1,14 +1,22 @@
 import os
 import uuid
+import json
 from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadSignature
+from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import IntegrityError
 from datetime import datetime, timedelta, timezone
 from flask import abort
 import re
+import csv
+import math
+import click
+from flask.cli import AppGroup
+import numpy as np
 
 
 # ----------------- CONFIGURATION -----------------
@@ -19,6 +27,20 @@ app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False 
+app.config['RECOMMENDATIONS_TOP_K'] = 4
+app.config['RECOMMENDATIONS_CHUNK_SIZE'] = 100000
+app.config['ADMIN_EMAILS'] = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
+app.config['ANALYTICS_CHUNK_SIZE'] = 100000
+app.config['PLACES_FILE'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'places.csv')
+app.config['DEFAULT_SEARCH_RADIUS_KM'] = 50
+app.config['NEAR_SEARCH_LIMIT'] = 60
+app.config['CART_MAX_AGE_DAYS'] = 30
+app.config['ORDER_ARCHIVE_AFTER_DAYS'] = 180
+# Checkout marks orders 'confirmed' and nothing moves them on from there, so
+# until the app tracks fulfilment, a placed order counts as finished
+app.config['ORDER_ARCHIVE_STATUSES'] = ('confirmed', 'shipped', 'delivered', 'completed', 'cancelled')
+app.config['ORDER_ARCHIVE_BATCH_SIZE'] = 10000
+app.config['INCREMENTAL_VACUUM_PAGES'] = 2000
 
 db = SQLAlchemy(app)
 s = URLSafeTimedSerializer(app.config['SECRET_KEY'])
@@ -40,6 +62,9 @@ class User(db.Model):
     is_consultant = db.Column(db.Boolean, default=False)
     consultant_category = db.Column(db.String(100))
     consultant_approved = db.Column(db.Boolean, default=False)
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    geohash = db.Column(db.String(12), index=True)
     
     products = db.relationship('Product', backref='owner', lazy=True, cascade='all, delete-orphan')
     posts = db.relationship('Post', backref='author', lazy=True, cascade='all, delete-orphan')
@@ -56,25 +81,42 @@ class Category(db.Model):
     description = db.Column(db.Text)
     parent_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=True)
     type = db.Column(db.String(50))
+    # Products and posts in this category and all of its descendants
+    product_count = db.Column(db.Integer, default=0)
+    post_count = db.Column(db.Integer, default=0)
     
     # Relationships
     posts = db.relationship('Post', backref='category', lazy=True)
     products = db.relationship('Product', backref='product_category', lazy=True)
 
+    __table_args__ = (
+        db.Index('ix_category_type_name', 'type', 'name'),
+    )
+
+class CategoryClosure(db.Model):
+    # Every (ancestor, descendant) pair in the category tree, including
+    # each category paired with itself at depth 0
+    ancestor_id = db.Column(db.Integer, db.ForeignKey('category.id', ondelete='CASCADE'), primary_key=True)
+    descendant_id = db.Column(db.Integer, db.ForeignKey('category.id', ondelete='CASCADE'), primary_key=True, index=True)
+    depth = db.Column(db.Integer, nullable=False)
+
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     price = db.Column(db.Float, nullable=False)
     description = db.Column(db.Text, nullable=False)
     image = db.Column(db.String(200), nullable=True)
-    category = db.Column(db.String(100), nullable=False)
+    category = db.Column(db.String(100), nullable=False, index=True)
     subcategory = db.Column(db.String(100))
     featured = db.Column(db.Boolean, default=False)
     active = db.Column(db.Boolean, default=True)
     stock_quantity = db.Column(db.Integer, default=1)
     created_date = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'))
-    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), index=True)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=True, index=True)
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    geohash = db.Column(db.String(12), index=True)
     
     # Relationships
     orders = db.relationship('Order', backref='product', lazy=True, cascade='all, delete-orphan')
@@ -86,12 +128,16 @@ class Post(db.Model):
     title = db.Column(db.String(200), nullable=False)
     content = db.Column(db.Text, nullable=False)
     post_type = db.Column(db.String(50))
-    category_id = db.Column(db.Integer, db.ForeignKey('category.id', ondelete='SET NULL'), nullable=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'))
-    created_date = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id', ondelete='SET NULL'), nullable=True, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), index=True)
+    created_date = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), index=True)
     tags = db.Column(db.String(200))
     product_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'))
 
+    __table_args__ = (
+        db.Index('ix_post_post_type_created_date', 'post_type', 'created_date'),
+    )
+
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'))
@@ -102,12 +148,42 @@ class Order(db.Model):
     created_date = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     shipping_address = db.Column(db.Text)
 
+    __table_args__ = (
+        db.Index('ix_order_user_id_created_date', 'user_id', 'created_date'),
+    )
+
+class ArchivedOrder(db.Model):
+    # Completed orders moved out of the hot order table, same ids and columns
+    __tablename__ = 'order_archive'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'))
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'))
+    quantity = db.Column(db.Integer, default=1)
+    total_price = db.Column(db.Float, nullable=False)
+    status = db.Column(db.String(50))
+    created_date = db.Column(db.DateTime(timezone=True))
+    shipping_address = db.Column(db.Text)
+    archived_date = db.Column(db.DateTime(timezone=True), server_default=db.func.current_timestamp())
+
+    product = db.relationship('Product', lazy=True)
+    customer = db.relationship('User', lazy=True)
+
+    __table_args__ = (
+        db.Index('ix_order_archive_user_id_created_date', 'user_id', 'created_date'),
+    )
+
 class CartItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'))
     product_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'))
     quantity = db.Column(db.Integer, default=1)
     added_date = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    updated_date = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc),
+                             onupdate=lambda: datetime.now(timezone.utc))
+
+    __table_args__ = (
+        db.Index('ix_cart_item_user_id_product_id', 'user_id', 'product_id'),
+    )
 
 class Consultation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -120,6 +196,19 @@ class Consultation(db.Model):
     scheduled_date = db.Column(db.DateTime, nullable=True)
     consultation_fee = db.Column(db.Float, default=0)
 
+class ProductPairCount(db.Model):
+    # Sparse co-purchase matrix, stored in both directions
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'), primary_key=True)
+    other_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class ProductRecommendation(db.Model):
+    # Top-k "frequently bought together" neighbours of each product
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    recommended_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'), nullable=False)
+    score = db.Column(db.Integer, nullable=False)
+
 # ----------------- HELPER FUNCTIONS -----------------
 
 def save_file(file):
@@ -154,6 +243,100 @@ def clear_cart(user_id):
     CartItem.query.filter_by(user_id=user_id).delete()
     db.session.commit()
 
+def get_cart_summary(user_id):
+    """Return (total, item_count) for user's cart in a single query"""
+    total, item_count = db.session.query(
+        db.func.coalesce(db.func.sum(Product.price * CartItem.quantity), 0),
+        db.func.count(CartItem.id)
+    ).select_from(CartItem).outerjoin(Product, CartItem.product_id == Product.id) \
+        .filter(CartItem.user_id == user_id).one()
+    return float(total), item_count
+
+SQLITE_MAX_INTEGER = 2 ** 63 - 1
+
+def apply_cart_operations(user_id, operations, merge=False):
+    """Apply a list of {product_id, quantity} operations to user's cart.
+
+    By default each quantity replaces the current one (0 removes the item).
+    With merge=True quantities are added to the cart instead, and unavailable
+    products are skipped or clamped to stock, which is what a guest cart
+    merged on login needs. Products and cart rows are loaded with one query
+    each and nothing is changed unless the whole batch is valid. The caller
+    commits.
+    """
+    if not isinstance(operations, list):
+        raise ValueError("Items must be a list of {product_id, quantity} objects.")
+
+    requested = {}
+    for operation in operations:
+        try:
+            product_id = operation['product_id']
+            quantity = operation.get('quantity', 1)
+            # int() would silently truncate 2.7 to 2, so only whole numbers pass
+            if any(isinstance(value, bool) or (isinstance(value, float) and not value.is_integer())
+                   for value in (product_id, quantity)):
+                raise ValueError
+            product_id = int(product_id)
+            quantity = int(quantity)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise ValueError("Each item needs an integer product_id and quantity.")
+        if quantity < 0:
+            raise ValueError("Quantity cannot be negative.")
+        # SQLite integers are 64-bit; anything larger fails inside the driver
+        if not 0 < product_id <= SQLITE_MAX_INTEGER or quantity > SQLITE_MAX_INTEGER:
+            raise ValueError("product_id or quantity is out of range.")
+        if merge:
+            requested[product_id] = requested.get(product_id, 0) + quantity
+        else:
+            requested[product_id] = quantity
+
+    if not requested:
+        return
+
+    products = {p.id: p for p in Product.query.filter(Product.id.in_(requested)).all()}
+    cart_items = {item.product_id: item for item in CartItem.query.filter(
+        CartItem.user_id == user_id,
+        CartItem.product_id.in_(requested)
+    ).all()}
+
+    # Validate everything before touching the session
+    changes = {}
+    for product_id, quantity in requested.items():
+        product = products.get(product_id)
+        cart_item = cart_items.get(product_id)
+        if merge and cart_item:
+            quantity += cart_item.quantity
+
+        if quantity > 0 and (product is None or not product.active):
+            if merge:
+                continue
+            raise ValueError(f"Product {product_id} is not available.")
+
+        if quantity > 0:
+            stock = product.stock_quantity or 0
+            if quantity > stock:
+                if not merge:
+                    raise ValueError(f"Only {stock} of {product.name} available")
+                quantity = stock
+        changes[product_id] = quantity
+
+    for product_id, quantity in changes.items():
+        cart_item = cart_items.get(product_id)
+        if quantity <= 0:
+            if cart_item:
+                db.session.delete(cart_item)
+        elif cart_item:
+            cart_item.quantity = quantity
+        else:
+            db.session.add(CartItem(user_id=user_id, product_id=product_id, quantity=quantity))
+
+def is_admin():
+    """Check if the logged-in user is listed in ADMIN_EMAILS"""
+    if 'user_id' not in session:
+        return False
+    user = User.query.get(session['user_id'])
+    return bool(user) and user.email in app.config['ADMIN_EMAILS']
+
 def validate_email(email):
     pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
     return re.match(pattern, email) is not None
@@ -164,6 +347,1218 @@ def validate_price(price):
     except (ValueError, TypeError):
         return False
 
+# ----------------- CATEGORY TREE -----------------
+# The closure table holds every ancestor/descendant pair, so a whole
+# subtree is one indexed lookup. Each category keeps product and post
+# counts for its subtree, updated as items are added. The counts cover what
+# the listings show: active products, and blog posts.
+
+# Post categories offered on the new post form, as (form value, category name)
+POST_CATEGORIES = (
+    ('crop_management', 'Crop Management'),
+    ('irrigation', 'Irrigation & Water'),
+    ('soil_health', 'Soil Health'),
+    ('pest_disease', 'Pest & Disease Control'),
+    ('market_prices', 'Market Prices'),
+    ('success_stories', 'Success Stories'),
+    ('new_technology', 'New Technology'),
+    ('organic_farming', 'Organic Farming'),
+    ('livestock', 'Livestock'),
+    ('general', 'General Discussion'),
+)
+
+def add_category(name, parent_id=None, category_type='product'):
+    """Create a category and its closure rows. Caller commits."""
+    category = Category(name=name, parent_id=parent_id, type=category_type, product_count=0, post_count=0)
+    db.session.add(category)
+    db.session.flush()
+
+    db.session.add(CategoryClosure(ancestor_id=category.id, descendant_id=category.id, depth=0))
+    if parent_id:
+        db.session.execute(db.insert(CategoryClosure).from_select(
+            ['ancestor_id', 'descendant_id', 'depth'],
+            db.select(CategoryClosure.ancestor_id, db.literal(category.id), CategoryClosure.depth + 1)
+            .where(CategoryClosure.descendant_id == parent_id)
+        ))
+    return category
+
+def get_or_create_category(name, parent_id=None, category_type='product'):
+    """Find a category by name (case-insensitive) under parent_id, creating it if needed"""
+    name = name.strip()
+    category = Category.query.filter(
+        db.func.lower(Category.name) == name.lower(),
+        Category.parent_id == parent_id,
+        Category.type == category_type
+    ).first()
+    return category or add_category(name, parent_id, category_type)
+
+def category_descendants(category_id):
+    """Subquery of category_id and all of its descendant ids"""
+    return db.select(CategoryClosure.descendant_id).where(CategoryClosure.ancestor_id == category_id)
+
+def unlinked_products_in(category):
+    """Condition for products not yet linked to the tree but named under category.
+
+    Products listed before the tree existed keep only their category and
+    subcategory strings until rebuild_category_tree links them.
+    """
+    name = db.func.lower(category.name)
+    if category.parent_id is None:
+        return db.and_(Product.category_id.is_(None), db.func.lower(Product.category) == name)
+    parent = Category.query.get(category.parent_id)
+    return db.and_(
+        Product.category_id.is_(None),
+        db.func.lower(Product.category) == db.func.lower(parent.name if parent else ''),
+        db.func.lower(Product.subcategory) == name
+    )
+
+def adjust_category_counts(category_id, products=0, posts=0):
+    """Add to the product/post counts of a category and all its ancestors. Caller commits."""
+    if not category_id:
+        return
+    values = {}
+    if products:
+        values['product_count'] = db.func.coalesce(Category.product_count, 0) + products
+    if posts:
+        values['post_count'] = db.func.coalesce(Category.post_count, 0) + posts
+    if values:
+        Category.query.filter(Category.id.in_(
+            db.select(CategoryClosure.ancestor_id).where(CategoryClosure.descendant_id == category_id)
+        )).update(values, synchronize_session=False)
+
+def category_tree(category_type):
+    """Return [(category, depth)] of one category type in display order"""
+    categories = Category.query.filter_by(type=category_type).order_by(Category.name).all()
+    ids = {category.id for category in categories}
+    children = {}
+    for category in categories:
+        parent_id = category.parent_id if category.parent_id in ids else None
+        children.setdefault(parent_id, []).append(category)
+
+    tree = []
+    stack = [(category, 0) for category in reversed(children.get(None, []))]
+    seen = set()
+    while stack:
+        category, depth = stack.pop()
+        if category.id in seen:
+            continue
+        seen.add(category.id)
+        tree.append((category, depth))
+        stack.extend((child, depth + 1) for child in reversed(children.get(category.id, [])))
+    return tree
+
+def resolve_category(value, category_type):
+    """Look up a category from a request argument holding an id or a top-level name"""
+    if not value:
+        return None
+    if value.isdigit():
+        return Category.query.filter_by(id=int(value), type=category_type).first()
+    return Category.query.filter(
+        db.func.lower(Category.name) == value.strip().lower(),
+        Category.parent_id.is_(None),
+        Category.type == category_type
+    ).first()
+
+def rebuild_category_tree():
+    """Link products to categories, then rebuild closure rows and counts from parent_id"""
+    linked = 0
+    for product in Product.query.filter(Product.category_id.is_(None)).all():
+        category = get_or_create_category(product.category)
+        if product.subcategory:
+            category = get_or_create_category(product.subcategory, category.id)
+        product.category_id = category.id
+        linked += 1
+    db.session.flush()
+
+    parents = dict(db.session.query(Category.id, Category.parent_id).all())
+    CategoryClosure.query.delete()
+    rows = []
+    for category_id in parents:
+        ancestor_id, depth, seen = category_id, 0, set()
+        while ancestor_id is not None and ancestor_id not in seen:
+            rows.append({'ancestor_id': ancestor_id, 'descendant_id': category_id, 'depth': depth})
+            seen.add(ancestor_id)
+            ancestor_id = parents.get(ancestor_id)
+            depth += 1
+    if rows:
+        db.session.execute(db.insert(CategoryClosure), rows)
+
+    def subtree_count(model, condition):
+        return db.select(db.func.count(model.id)).join(
+            CategoryClosure, CategoryClosure.descendant_id == model.category_id
+        ).where(CategoryClosure.ancestor_id == Category.id, condition).scalar_subquery()
+
+    db.session.execute(db.update(Category).values(
+        product_count=subtree_count(Product, Product.active == True),
+        post_count=subtree_count(Post, Post.post_type == 'blog')
+    ))
+    db.session.commit()
+    return linked, len(parents)
+
+@app.cli.command('rebuild-categories')
+def rebuild_categories_command():
+    """Link products to the category tree and recompute closure rows and counts."""
+    db.create_all()
+    linked, categories = rebuild_category_tree()
+    click.echo(f"Linked {linked} products, indexed {categories} categories.")
+
+# ----------------- RECOMMENDATIONS -----------------
+
+def co_purchase_pairs(baskets, products):
+    """Count how often each pair of products shares a basket.
+
+    baskets and products are parallel integer arrays with one entry per
+    order line. Returns (left, right, counts) arrays holding both
+    orientations of every co-purchased pair.
+    """
+    empty = np.empty(0, dtype=np.int64)
+    if len(products) == 0:
+        return empty, empty, empty
+
+    # One row per distinct (basket, product), sorted by basket
+    rows = np.unique(np.stack([baskets, products], axis=1), axis=0)
+    baskets, products = rows[:, 0], rows[:, 1]
+    starts = np.flatnonzero(np.r_[True, baskets[1:] != baskets[:-1]])
+    sizes = np.diff(np.r_[starts, len(baskets)])
+    row_sizes = np.repeat(sizes, sizes)
+    row_starts = np.repeat(starts, sizes)
+
+    # Pair every row with every row of its own basket
+    left = np.repeat(np.arange(len(products)), row_sizes)
+    offsets = np.arange(len(left)) - np.repeat(np.cumsum(row_sizes) - row_sizes, row_sizes)
+    right = np.repeat(row_starts, row_sizes) + offsets
+    keep = left != right
+    if not keep.any():
+        return empty, empty, empty
+
+    pairs, counts = np.unique(
+        np.stack([products[left[keep]], products[right[keep]]], axis=1),
+        axis=0, return_counts=True
+    )
+    return pairs[:, 0], pairs[:, 1], counts
+
+def top_k_neighbours(left, right, counts, k):
+    """Keep the k most co-purchased neighbours of each product.
+
+    Returns (product_ids, ranks, recommended_ids, scores) arrays.
+    """
+    order = np.lexsort((right, -counts, left))
+    left, right, counts = left[order], right[order], counts[order]
+    starts = np.flatnonzero(np.r_[True, left[1:] != left[:-1]])
+    ranks = np.arange(len(left)) - np.repeat(starts, np.diff(np.r_[starts, len(left)]))
+    keep = ranks < k
+    return left[keep], ranks[keep], right[keep], counts[keep]
+
+def save_recommendations(left, right, counts):
+    """Write top-k rows for the given pair counts. Caller commits."""
+    product_ids, ranks, recommended_ids, scores = top_k_neighbours(
+        left, right, counts, app.config['RECOMMENDATIONS_TOP_K'])
+    if len(product_ids):
+        db.session.execute(db.insert(ProductRecommendation), [
+            {'product_id': p, 'rank': r, 'recommended_id': o, 'score': c}
+            for p, r, o, c in zip(product_ids.tolist(), ranks.tolist(),
+                                  recommended_ids.tolist(), scores.tolist())
+        ])
+    return len(product_ids)
+
+def sum_pair_counts(left, right, counts):
+    """Merge duplicate (left, right) pairs by adding their counts"""
+    if len(counts) == 0:
+        return left, right, counts
+    pairs, inverse = np.unique(np.stack([left, right], axis=1), axis=0, return_inverse=True)
+    counts = np.bincount(inverse.reshape(-1), weights=counts, minlength=len(pairs))
+    return pairs[:, 0], pairs[:, 1], counts.astype(np.int64)
+
+def iter_basket_chunks(chunk_size=None):
+    """Stream order lines as (user_id, placed_at, product_id) arrays.
+
+    Orders placed by the same user at the same time (to the millisecond)
+    form one basket, which is how checkout stamps the orders of a cart.
+    Lines are read in (user_id, created_date) order, so a basket can only
+    straddle the end of a chunk; its lines are held back for the next one
+    and every chunk holds whole baskets.
+    """
+    chunk_size = chunk_size or app.config['RECOMMENDATIONS_CHUNK_SIZE']
+    for model in (Order, ArchivedOrder):
+        placed_at = db.func.replace(db.func.strftime('%Y%m%d%H%M%f', model.created_date), '.', '')
+        select = db.select(
+            db.func.coalesce(model.user_id, -1),
+            db.cast(placed_at, db.Integer),
+            model.product_id
+        ).where(model.product_id.isnot(None)).order_by(model.user_id, model.created_date)
+        result = db.session.execute(select.execution_options(yield_per=chunk_size))
+        pending = np.empty((0, 3), dtype=np.int64)
+        for rows in result.partitions(chunk_size):
+            columns = np.concatenate([pending, np.array(list(zip(*rows)), dtype=np.int64).T])
+            last_basket = (columns[:, 0] == columns[-1, 0]) & (columns[:, 1] == columns[-1, 1])
+            pending = columns[last_basket]
+            if not last_basket.all():
+                yield columns[~last_basket]
+        if len(pending):
+            yield pending
+
+def rebuild_recommendations(chunk_size=None):
+    """Recompute co-purchase counts and recommendations from all orders.
+
+    Orders are streamed in chunks of whole baskets and each chunk's pair
+    counts are folded into the running totals, so memory grows with the
+    number of distinct pairs rather than the number of orders.
+    """
+    chunk_size = chunk_size or app.config['RECOMMENDATIONS_CHUNK_SIZE']
+    empty = np.empty(0, dtype=np.int64)
+    left, right, counts = empty, empty, empty
+    for columns in iter_basket_chunks(chunk_size):
+        _, baskets = np.unique(columns[:, :2], axis=0, return_inverse=True)
+        chunk_left, chunk_right, chunk_counts = co_purchase_pairs(baskets.reshape(-1), columns[:, 2])
+        left, right, counts = sum_pair_counts(
+            np.concatenate([left, chunk_left]),
+            np.concatenate([right, chunk_right]),
+            np.concatenate([counts, chunk_counts])
+        )
+
+    ProductRecommendation.query.delete()
+    ProductPairCount.query.delete()
+    for start in range(0, len(counts), chunk_size):
+        stop = start + chunk_size
+        db.session.execute(db.insert(ProductPairCount), [
+            {'product_id': a, 'other_id': b, 'count': c}
+            for a, b, c in zip(left[start:stop].tolist(), right[start:stop].tolist(),
+                               counts[start:stop].tolist())
+        ])
+    saved = save_recommendations(left, right, counts)
+    db.session.commit()
+    return len(counts), saved
+
+def record_co_purchases(product_ids):
+    """Add one checkout's basket to the co-purchase counts.
+
+    Only the top-k lists of the products in the basket are refreshed.
+    Caller commits.
+    """
+    product_ids = sorted(set(product_ids))
+    if len(product_ids) < 2:
+        return
+
+    # Upsert so two checkouts creating the same new pair don't collide on the key
+    upsert = sqlite_insert(ProductPairCount).values([
+        {'product_id': product_id, 'other_id': other_id, 'count': 1}
+        for product_id in product_ids for other_id in product_ids
+        if product_id != other_id
+    ])
+    db.session.execute(upsert.on_conflict_do_update(
+        index_elements=['product_id', 'other_id'],
+        set_={'count': ProductPairCount.count + 1}
+    ))
+
+    rows = db.session.query(
+        ProductPairCount.product_id, ProductPairCount.other_id, ProductPairCount.count
+    ).filter(ProductPairCount.product_id.in_(product_ids)).all()
+    left, right, counts = np.array(rows, dtype=np.int64).reshape(-1, 3).T
+
+    ProductRecommendation.query.filter(
+        ProductRecommendation.product_id.in_(product_ids)
+    ).delete(synchronize_session=False)
+    save_recommendations(left, right, counts)
+
+def get_recommendations(product_id):
+    """Get active products frequently bought together with product_id"""
+    return Product.query.join(
+        ProductRecommendation, ProductRecommendation.recommended_id == Product.id
+    ).filter(
+        ProductRecommendation.product_id == product_id,
+        Product.active == True
+    ).order_by(ProductRecommendation.rank).all()
+
+@app.cli.command('build-recommendations')
+def build_recommendations_command():
+    """Rebuild "frequently bought together" recommendations from orders."""
+    db.create_all()
+    pairs, saved = rebuild_recommendations()
+    click.echo(f"Counted {pairs} co-purchased pairs, saved {saved} recommendations.")
+
+# ----------------- SALES ANALYTICS -----------------
+# Orders are streamed in fixed-size chunks of columnar arrays and reduced
+# into per-group sums, so memory is bounded by the number of groups
+# (buckets, categories, sellers, products) rather than the number of orders.
+
+REPORT_BUCKETS = ('day', 'week', 'month')
+ORDER_COLUMNS = ('created', 'product_id', 'quantity', 'revenue')
+SECONDS_PER_DAY = 86400
+
+def iter_order_chunks(chunk_size=None, last_id=None):
+    """Stream all orders, hot and archived, as dicts of NumPy column arrays"""
+    chunk_size = chunk_size or app.config['ANALYTICS_CHUNK_SIZE']
+    for model in (Order, ArchivedOrder):
+        select = db.select(
+            db.cast(db.func.strftime('%s', model.created_date), db.Integer),
+            db.func.coalesce(model.product_id, -1),
+            db.func.coalesce(model.quantity, 1),
+            model.total_price
+        ).order_by(model.id)
+        if last_id is not None:
+            select = select.where(model.id <= last_id)
+        result = db.session.execute(select.execution_options(yield_per=chunk_size))
+        for rows in result.partitions(chunk_size):
+            columns = list(zip(*rows))
+            yield {
+                'created': np.array(columns[0], dtype=np.int64),
+                'product_id': np.array(columns[1], dtype=np.int64),
+                'quantity': np.array(columns[2], dtype=np.int64),
+                'revenue': np.array(columns[3], dtype=np.float64),
+            }
+
+def write_order_snapshot(path, chunk_size=None):
+    """Dump all orders to memory-mapped .npy column files under path.
+
+    The files are sized from a count taken before streaming. If orders are
+    deleted or archived in between, fewer rows arrive and the columns are
+    cut down to the rows actually written, so no zero-filled tail is left.
+    """
+    chunk_size = chunk_size or app.config['ANALYTICS_CHUNK_SIZE']
+    os.makedirs(path, exist_ok=True)
+    last_id = max(db.session.query(db.func.max(Order.id)).scalar() or 0,
+                  db.session.query(db.func.max(ArchivedOrder.id)).scalar() or 0)
+    total = (Order.query.filter(Order.id <= last_id).count()
+             + ArchivedOrder.query.filter(ArchivedOrder.id <= last_id).count())
+
+    dtypes = {'created': np.int64, 'product_id': np.int64, 'quantity': np.int64, 'revenue': np.float64}
+    files = {name: np.lib.format.open_memmap(os.path.join(path, f'{name}.npy.partial'), mode='w+',
+                                              dtype=dtypes[name], shape=(total,))
+             for name in ORDER_COLUMNS}
+    written = 0
+    for chunk in iter_order_chunks(chunk_size, last_id):
+        size = min(len(chunk['created']), total - written)
+        for name in ORDER_COLUMNS:
+            files[name][written:written + size] = chunk[name][:size]
+        written += size
+        if written >= total:
+            break
+
+    for name in ORDER_COLUMNS:
+        column = files.pop(name)
+        partial = os.path.join(path, f'{name}.npy.partial')
+        final = os.path.join(path, f'{name}.npy')
+        if written == total:
+            column.flush()
+            del column
+            os.replace(partial, final)
+            continue
+        trimmed = np.lib.format.open_memmap(final, mode='w+', dtype=dtypes[name], shape=(written,))
+        for start in range(0, written, chunk_size):
+            trimmed[start:start + chunk_size] = column[start:start + chunk_size]
+        trimmed.flush()
+        del trimmed, column
+        os.remove(partial)
+    return written
+
+def iter_snapshot_chunks(path, chunk_size=None):
+    """Stream a snapshot written by write_order_snapshot in chunks"""
+    chunk_size = chunk_size or app.config['ANALYTICS_CHUNK_SIZE']
+    files = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in ORDER_COLUMNS}
+    total = len(files['created'])
+    for start in range(0, total, chunk_size):
+        yield {name: np.asarray(column[start:start + chunk_size]) for name, column in files.items()}
+
+def load_product_dimensions():
+    """Return per-product lookup arrays (seller, category code) and category names"""
+    rows = db.session.query(Product.id, db.func.coalesce(Product.user_id, -1), Product.category).all()
+    size = max((row[0] for row in rows), default=0) + 1
+    seller_of = np.full(size, -1, dtype=np.int64)
+    category_of = np.full(size, -1, dtype=np.int64)
+    category_names = []
+    if rows:
+        ids, sellers, categories = zip(*rows)
+        category_names, codes = np.unique(np.array(categories, dtype=object), return_inverse=True)
+        category_names = list(category_names)
+        seller_of[list(ids)] = sellers
+        category_of[list(ids)] = codes.reshape(-1)
+    return seller_of, category_of, category_names
+
+def bucket_index(created, bucket):
+    """Map epoch seconds to day, Monday-based week or month numbers"""
+    if bucket == 'day':
+        return created // SECONDS_PER_DAY
+    if bucket == 'week':
+        # 1970-01-01 was a Thursday, shift so weeks start on Monday
+        return (created + 3 * SECONDS_PER_DAY) // (7 * SECONDS_PER_DAY)
+    return created.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64)
+
+def bucket_start(index, bucket):
+    """Return the first day of a bucket as YYYY-MM-DD"""
+    if bucket == 'day':
+        day = np.datetime64(int(index), 'D')
+    elif bucket == 'week':
+        day = np.datetime64(int(index) * 7 - 3, 'D')
+    else:
+        day = np.datetime64(int(index), 'M').astype('datetime64[D]')
+    return str(day)
+
+def group_sums(keys, revenue, units):
+    """Sum revenue and units per distinct key"""
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    return (unique_keys,
+            np.bincount(inverse, weights=revenue, minlength=len(unique_keys)),
+            np.bincount(inverse, weights=units, minlength=len(unique_keys)))
+
+def aggregate_sales(chunks, seller_of, category_of, n_categories, bucket='week', start=None, end=None):
+    """Reduce order chunks into revenue/units per bucket, category, seller and product.
+
+    start and end are optional epoch-second bounds (end exclusive). Returns
+    a dict mapping each breakdown name to (keys, revenue, units) arrays;
+    bucket_category keys encode bucket * (n_categories + 1) + category.
+    """
+    groups = {}
+    unknown_category = n_categories
+    for chunk in chunks:
+        created, product_ids = chunk['created'], chunk['product_id']
+        mask = np.ones(len(created), dtype=bool)
+        if start is not None:
+            mask &= created >= start
+        if end is not None:
+            mask &= created < end
+        if not mask.any():
+            continue
+
+        created, product_ids = created[mask], product_ids[mask]
+        revenue = chunk['revenue'][mask]
+        units = chunk['quantity'][mask].astype(np.float64)
+
+        known = (product_ids >= 0) & (product_ids < len(seller_of))
+        safe_ids = np.where(known, product_ids, 0)
+        sellers = np.where(known, seller_of[safe_ids], -1)
+        categories = np.where(known, category_of[safe_ids], -1)
+        categories = np.where(categories < 0, unknown_category, categories)
+        buckets = bucket_index(created, bucket)
+
+        keys = {
+            'bucket': buckets,
+            'category': categories,
+            'seller': sellers,
+            'product': product_ids,
+            'bucket_category': buckets * (n_categories + 1) + categories,
+        }
+        for name, chunk_keys in keys.items():
+            chunk_keys, chunk_revenue, chunk_units = group_sums(chunk_keys, revenue, units)
+            if name in groups:
+                previous_keys, previous_revenue, previous_units = groups[name]
+                chunk_keys, chunk_revenue, chunk_units = group_sums(
+                    np.concatenate([previous_keys, chunk_keys]),
+                    np.concatenate([previous_revenue, chunk_revenue]),
+                    np.concatenate([previous_units, chunk_units]))
+            groups[name] = (chunk_keys, chunk_revenue, chunk_units)
+
+    empty = (np.empty(0, dtype=np.int64), np.empty(0), np.empty(0))
+    return {name: groups.get(name, empty)
+            for name in ('bucket', 'category', 'seller', 'product', 'bucket_category')}
+
+def sales_report(bucket='week', top=10, start=None, end=None, snapshot=None):
+    """Build a JSON-serialisable sales report from the database or a snapshot"""
+    if bucket not in REPORT_BUCKETS:
+        raise ValueError(f"Bucket must be one of: {', '.join(REPORT_BUCKETS)}")
+    if top is None or top < 1:
+        raise ValueError("Top must be a positive integer.")
+
+    seller_of, category_of, category_names = load_product_dimensions()
+    chunks = iter_snapshot_chunks(snapshot) if snapshot else iter_order_chunks()
+    groups = aggregate_sales(chunks, seller_of, category_of, len(category_names), bucket, start, end)
+    category_names = category_names + ['Uncategorized']
+
+    def rows(name, label, limit=None):
+        keys, revenue, units = groups[name]
+        order = np.argsort(-revenue, kind='stable')[:limit]
+        return [{label: int(keys[i]), 'revenue': round(float(revenue[i]), 2), 'units': int(units[i])}
+                for i in order]
+
+    keys, revenue, units = groups['bucket']
+    total_revenue, total_units = float(revenue.sum()), int(units.sum())
+    timeline = [{'bucket': bucket_start(k, bucket), 'revenue': round(float(r), 2), 'units': int(u)}
+                for k, r, u in zip(keys, revenue, units)]
+
+    keys, revenue, units = groups['bucket_category']
+    width = len(category_names)
+    timeline_by_category = [{
+        'bucket': bucket_start(k // width, bucket),
+        'category': category_names[k % width],
+        'revenue': round(float(r), 2),
+        'units': int(u),
+    } for k, r, u in zip(keys.tolist(), revenue, units)]
+
+    categories = rows('category', 'category')
+    for row in categories:
+        row['category'] = category_names[row['category']]
+
+    top_products = rows('product', 'product_id', top)
+    names = dict(db.session.query(Product.id, Product.name).filter(
+        Product.id.in_([row['product_id'] for row in top_products])).all())
+    for row in top_products:
+        row['name'] = names.get(row['product_id'])
+
+    top_sellers = rows('seller', 'seller_id', top)
+    usernames = dict(db.session.query(User.id, User.username).filter(
+        User.id.in_([row['seller_id'] for row in top_sellers])).all())
+    for row in top_sellers:
+        row['username'] = usernames.get(row['seller_id'])
+
+    return {
+        'bucket': bucket,
+        'total_revenue': round(total_revenue, 2),
+        'total_units': total_units,
+        'timeline': timeline,
+        'timeline_by_category': timeline_by_category,
+        'categories': categories,
+        'top_products': top_products,
+        'top_sellers': top_sellers,
+    }
+
+def parse_report_date(value):
+    """Parse YYYY-MM-DD into UTC epoch seconds, or None if empty"""
+    if not value:
+        return None
+    return int(datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp())
+
+analytics_cli = AppGroup('analytics', help='Sales analytics over orders.')
+app.cli.add_command(analytics_cli)
+
+@analytics_cli.command('snapshot')
+@click.argument('path', default=os.path.join(app.instance_path, 'analytics'))
+def analytics_snapshot_command(path):
+    """Write a memory-mapped snapshot of all orders to PATH."""
+    written = write_order_snapshot(path)
+    click.echo(f"Wrote {written} orders to {path}")
+
+@analytics_cli.command('report')
+@click.option('--bucket', type=click.Choice(REPORT_BUCKETS), default='week')
+@click.option('--top', default=10, type=click.IntRange(min=1), help='Number of top products and sellers.')
+@click.option('--start', help='First day to include (YYYY-MM-DD).')
+@click.option('--end', help='Day to stop before (YYYY-MM-DD).')
+@click.option('--snapshot', help='Read orders from a snapshot directory instead of the database.')
+@click.option('--as-json', is_flag=True, help='Print the raw JSON report.')
+def analytics_report_command(bucket, top, start, end, snapshot, as_json):
+    """Print revenue and units per bucket, category, product and seller."""
+    report = sales_report(bucket, top, parse_report_date(start), parse_report_date(end), snapshot)
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+
+    click.echo(f"Total revenue: PKR {report['total_revenue']:.2f}  Units: {report['total_units']}")
+    sections = (
+        (f'Revenue per {bucket}', report['timeline'], 'bucket'),
+        (f'Revenue per category per {bucket}', report['timeline_by_category'], ('bucket', 'category')),
+        ('Revenue per category', report['categories'], 'category'),
+        ('Top products', report['top_products'], 'name'),
+        ('Top sellers', report['top_sellers'], 'username'),
+    )
+    for title, rows, label in sections:
+        click.echo(f"\n{title}")
+        for row in rows:
+            name = ' / '.join(str(row[key]) for key in label) if isinstance(label, tuple) else str(row[label])
+            click.echo(f"  {name:<40} PKR {row['revenue']:>14.2f} {row['units']:>10}")
+
+# ----------------- LOCATION SEARCH -----------------
+# Users and products carry coordinates plus a geohash. Nearby cells share a
+# geohash prefix, so a radius search reads a few index ranges (the cells
+# covering the search box), narrows them with a latitude/longitude BETWEEN,
+# and then checks exact distances on that small candidate set.
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 9
+GEOHASH_MAX_CELLS = 64
+EARTH_RADIUS_KM = 6371.0
+# Must match distance_km, or the search box cuts off hits near its edge
+KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180
+
+_places = None
+
+def load_places():
+    """Load the bundled place table as {lowercase name: (latitude, longitude)}"""
+    global _places
+    if _places is None:
+        with open(app.config['PLACES_FILE'], newline='', encoding='utf-8') as f:
+            _places = {row['name'].strip().lower(): (float(row['latitude']), float(row['longitude']))
+                       for row in csv.DictReader(f)}
+    return _places
+
+def geocode(location):
+    """Turn free-text location into (latitude, longitude) without network access.
+
+    Accepts "lat, lon" pairs or place names from the bundled table. For
+    "City, Province, Country" the most specific known part wins.
+    """
+    if not location:
+        return None
+
+    parts = [part.strip().lower() for part in location.split(',') if part.strip()]
+    if len(parts) == 2:
+        try:
+            latitude, longitude = float(parts[0]), float(parts[1])
+            if -90 <= latitude <= 90 and -180 <= longitude <= 180:
+                return latitude, longitude
+        except ValueError:
+            pass
+
+    places = load_places()
+    for part in parts:
+        if part in places:
+            return places[part]
+    text = ' '.join(parts)
+    for name in sorted(places, key=len, reverse=True):
+        if re.search(r'\b' + re.escape(name) + r'\b', text):
+            return places[name]
+    return None
+
+def geohash_encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    """Encode coordinates as a geohash string"""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = bit_count = 0
+    even = True
+    while len(chars) < precision:
+        value_range, value = (lon_range, longitude) if even else (lat_range, latitude)
+        middle = (value_range[0] + value_range[1]) / 2
+        if value >= middle:
+            bits = bits * 2 + 1
+            value_range[0] = middle
+        else:
+            bits = bits * 2
+            value_range[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_BASE32[bits])
+            bits = bit_count = 0
+    return ''.join(chars)
+
+def geohash_cell_size(precision):
+    """Return (latitude, longitude) size in degrees of a geohash cell"""
+    lon_bits = math.ceil(precision * 5 / 2)
+    lat_bits = precision * 5 // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+def geohash_successor(prefix):
+    """Smallest prefix that sorts after every geohash starting with prefix (None if none)"""
+    while prefix:
+        index = GEOHASH_BASE32.index(prefix[-1])
+        if index < len(GEOHASH_BASE32) - 1:
+            return prefix[:-1] + GEOHASH_BASE32[index + 1]
+        prefix = prefix[:-1]
+    return None
+
+def bounding_box(latitude, longitude, radius_km):
+    """Return (min_lat, min_lon, max_lat, max_lon) enclosing radius_km around a point.
+
+    Longitudes may run past +/-180 when the box crosses the antimeridian.
+    """
+    # The small pad keeps points exactly on the circle from being lost to rounding
+    lat_delta = radius_km / KM_PER_DEGREE + 1e-9
+    min_lat, max_lat = max(latitude - lat_delta, -90.0), min(latitude + lat_delta, 90.0)
+    widest_latitude = max(abs(min_lat), abs(max_lat))
+    if widest_latitude >= 89.9:
+        lon_delta = 180.0
+    else:
+        lon_delta = min(radius_km / (KM_PER_DEGREE * math.cos(math.radians(widest_latitude))) + 1e-9, 180.0)
+    return min_lat, longitude - lon_delta, max_lat, longitude + lon_delta
+
+def geohash_cover(min_lat, min_lon, max_lat, max_lon):
+    """Geohash ranges covering a bounding box, as sorted [(low, high)] pairs.
+
+    Uses the finest precision at which the box spans at most
+    GEOHASH_MAX_CELLS cells, and merges cells whose hashes are contiguous.
+    high is exclusive, or None for no upper bound.
+    """
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        lat_size, lon_size = geohash_cell_size(precision)
+        last_row = round(180.0 / lat_size) - 1
+        first_row = min(math.floor((min_lat + 90.0) / lat_size), last_row)
+        rows = min(math.floor((max_lat + 90.0) / lat_size), last_row) - first_row + 1
+        first_column = math.floor((min_lon + 180.0) / lon_size)
+        columns = min(math.floor((max_lon + 180.0) / lon_size) - first_column + 1, round(360.0 / lon_size))
+        if rows * columns <= GEOHASH_MAX_CELLS:
+            break
+
+    prefixes = set()
+    for row in range(first_row, first_row + rows):
+        lat = (row + 0.5) * lat_size - 90.0
+        for column in range(first_column, first_column + columns):
+            lon = ((column + 0.5) * lon_size) % 360.0 - 180.0
+            prefixes.add(geohash_encode(lat, lon, precision))
+
+    ranges = []
+    for prefix in sorted(prefixes):
+        if ranges and ranges[-1][1] is not None and prefix == ranges[-1][1].ljust(len(prefix), '0'):
+            ranges[-1][1] = geohash_successor(prefix)
+        else:
+            ranges.append([prefix, geohash_successor(prefix)])
+    return [tuple(cell_range) for cell_range in ranges]
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between points, element-wise for NumPy arrays"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def set_coordinates(obj, point):
+    """Store (latitude, longitude) and its geohash on a User or Product"""
+    if point:
+        obj.latitude, obj.longitude = point
+        obj.geohash = geohash_encode(*point)
+    else:
+        obj.latitude = obj.longitude = obj.geohash = None
+
+def within_radius(query, model, latitude, longitude, radius_km, limit=None):
+    """Return up to limit [(row, distance_km)] of query within radius_km, nearest first.
+
+    Only ids and coordinates of the candidates are read. Exact distances
+    are computed on those with NumPy, and full rows are loaded for the
+    results that are returned.
+    """
+    if limit is not None and limit < 1:
+        raise ValueError("Limit must be a positive integer.")
+    min_lat, min_lon, max_lat, max_lon = bounding_box(latitude, longitude, radius_km)
+    cells = [model.geohash >= low if high is None else db.and_(model.geohash >= low, model.geohash < high)
+             for low, high in geohash_cover(min_lat, min_lon, max_lat, max_lon)]
+    conditions = [db.or_(*cells), model.latitude.between(min_lat, max_lat)]
+    if max_lon - min_lon < 360.0:
+        if min_lon < -180.0:
+            conditions.append(db.or_(model.longitude >= min_lon + 360.0, model.longitude <= max_lon))
+        elif max_lon > 180.0:
+            conditions.append(db.or_(model.longitude >= min_lon, model.longitude <= max_lon - 360.0))
+        else:
+            conditions.append(model.longitude.between(min_lon, max_lon))
+
+    candidates = query.filter(*conditions).with_entities(model.id, model.latitude, model.longitude).all()
+    if not candidates:
+        return []
+    ids, latitudes, longitudes = (np.array(column) for column in zip(*candidates))
+    distances = distance_km(latitude, longitude, latitudes.astype(np.float64), longitudes.astype(np.float64))
+    inside = np.flatnonzero(distances <= radius_km)
+    order = inside[np.argsort(distances[inside], kind='stable')][:limit]
+    ids, distances = ids[order].tolist(), distances[order].tolist()
+    if not ids:
+        return []
+
+    rows = {row.id: row for row in query.filter(model.id.in_(ids)).all()}
+    return [(rows[row_id], distance) for row_id, distance in zip(ids, distances) if row_id in rows]
+
+def nearest(query, model, latitude, longitude, k, max_radius_km=2000):
+    """Return the k nearest [(row, distance_km)] of query, widening the search as needed"""
+    radius_km = 10
+    while True:
+        results = within_radius(query, model, latitude, longitude, radius_km, limit=k)
+        if len(results) >= k or radius_km >= max_radius_km:
+            return results
+        radius_km = min(radius_km * 4, max_radius_km)
+
+def search_near(query, model, near, radius_km=None, k=None):
+    """Apply a radius or k-nearest search around a place to query.
+
+    At most NEAR_SEARCH_LIMIT results are returned. Non-positive k and
+    radius_km come straight from the query string and are ignored. Returns
+    [(row, distance_km)], or None if near cannot be geocoded.
+    """
+    point = geocode(near)
+    if point is None:
+        return None
+    limit = app.config['NEAR_SEARCH_LIMIT']
+    if k and k > 0:
+        return nearest(query, model, point[0], point[1], min(k, limit))
+    if not radius_km or radius_km <= 0:
+        radius_km = app.config['DEFAULT_SEARCH_RADIUS_KM']
+    return within_radius(query, model, point[0], point[1], radius_km, limit=limit)
+
+def check_radius_search(model, samples=100, seed=0):
+    """Compare within_radius against a brute-force scan of model's coordinates.
+
+    Centres are random stored points, jittered, with random radii. Returns
+    a list of (latitude, longitude, radius_km, missing, extra) mismatches.
+    """
+    rows = db.session.query(model.id, model.latitude, model.longitude) \
+        .filter(model.geohash.isnot(None)).all()
+    if not rows:
+        return []
+    ids, latitudes, longitudes = (np.array(column) for column in zip(*rows))
+    latitudes, longitudes = latitudes.astype(np.float64), longitudes.astype(np.float64)
+    rng = np.random.default_rng(seed)
+    mismatches = []
+    for _ in range(samples):
+        index = rng.integers(len(ids))
+        latitude = float(np.clip(latitudes[index] + rng.normal(0, 0.5), -90.0, 90.0))
+        longitude = float((longitudes[index] + rng.normal(0, 0.5) + 180.0) % 360.0 - 180.0)
+        radius_km = float(rng.choice([1, 5, 25, 50, 200, 800]) * rng.uniform(0.5, 1.5))
+        expected = set(ids[distance_km(latitude, longitude, latitudes, longitudes) <= radius_km].tolist())
+        found = {row.id for row, _ in within_radius(model.query, model, latitude, longitude, radius_km)}
+        if found != expected:
+            mismatches.append((latitude, longitude, radius_km, len(expected - found), len(found - expected)))
+    return mismatches
+
+@app.cli.command('geocode')
+@click.option('--all', 'refresh', is_flag=True, help='Also re-geocode users and products that already have coordinates.')
+def geocode_command(refresh):
+    """Fill in coordinates for users from their location, and products from their seller."""
+    db.create_all()
+    located = backfill_coordinates(refresh)
+    click.echo(f"Located {located} users.")
+
+def backfill_coordinates(refresh=False):
+    """Geocode users and copy their coordinates to their products. Returns users located."""
+    users = User.query if refresh else User.query.filter(User.geohash.is_(None))
+    located = 0
+    for user in users.all():
+        set_coordinates(user, geocode(user.location))
+        located += user.geohash is not None
+
+    products = Product.query if refresh else Product.query.filter(Product.geohash.is_(None))
+    for product in products.all():
+        owner = product.owner
+        set_coordinates(product, (owner.latitude, owner.longitude) if owner and owner.geohash else None)
+    db.session.commit()
+    return located
+
+@app.cli.command('check-near-search')
+@click.option('--samples', default=100, type=click.IntRange(min=1), help='Random searches per table.')
+def check_near_search_command(samples):
+    """Check radius search results against a brute-force scan (exit 1 on mismatch)."""
+    failed = False
+    for model in (User, Product):
+        mismatches = check_radius_search(model, samples)
+        click.echo(f"{model.__tablename__}: {samples - len(mismatches)}/{samples} searches match.")
+        for latitude, longitude, radius_km, missing, extra in mismatches[:10]:
+            click.echo(f"  ({latitude:.4f}, {longitude:.4f}) within {radius_km:.1f} km: "
+                       f"{missing} missing, {extra} extra")
+        failed = failed or bool(mismatches)
+    if failed:
+        raise SystemExit(1)
+
+# ----------------- QUERY PLAN ADVISOR -----------------
+# Dev/CI tool: replays the read-only pages through the test client, runs
+# EXPLAIN QUERY PLAN on every SELECT they issue and suggests indexes for
+# full table scans and temporary sort B-trees.
+
+EQUALITY_COLUMN_RE = re.compile(r'"?(\w+)"?\.(\w+)\s*(?:=\s*\?|IN\s*\()', re.IGNORECASE)
+ORDER_BY_RE = re.compile(r'ORDER BY (.+?)(?:\s+LIMIT\b|\s+OFFSET\b|$)', re.IGNORECASE | re.DOTALL)
+COLUMN_RE = re.compile(r'"?(\w+)"?\.(\w+)')
+
+def run_route_suite(user_id=None):
+    """Request the app's GET pages, logged in as user_id if given"""
+    client = app.test_client()
+    paths = ['/', '/products', '/products?search=seed', '/products?near=Lahore', '/forum', '/blog',
+             '/consultants', '/consultants?near=Lahore&nearest=5']
+
+    product = Product.query.first()
+    if product:
+        paths += [f'/product/{product.id}', f'/products?category={product.category_id or product.category}']
+
+    user = User.query.get(user_id) if user_id else None
+    if user:
+        with client.session_transaction() as sess:
+            sess['user'] = user.username
+            sess['user_id'] = user.id
+            sess['is_consultant'] = user.is_consultant
+        paths += ['/dashboard', '/cart', '/checkout', '/orders', '/order_confirmation']
+
+    for path in paths:
+        client.get(path)
+    return paths
+
+def capture_select_statements(func, *args, **kwargs):
+    """Run func and return the distinct SELECT statements it executed"""
+    statements = {}
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith('SELECT'):
+            statements.setdefault(statement, parameters)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        func(*args, **kwargs)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    return statements
+
+def explain_query_plan(statement, parameters):
+    """Return the detail lines of EXPLAIN QUERY PLAN for a statement"""
+    rows = db.session.connection().exec_driver_sql(
+        'EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+    return [row[-1] for row in rows]
+
+def suggest_index(statement, table):
+    """Suggest index columns for table: equality filters first, then sort columns"""
+    columns = []
+    for match_table, column in EQUALITY_COLUMN_RE.findall(statement):
+        if match_table == table and column not in columns:
+            columns.append(column)
+    order_by = ORDER_BY_RE.search(statement)
+    if order_by:
+        for match_table, column in COLUMN_RE.findall(order_by.group(1)):
+            if match_table == table and column not in columns:
+                columns.append(column)
+    return tuple(columns)
+
+def advise_indexes(statements):
+    """Flag scans and temp B-trees in query plans.
+
+    Returns (findings, suggestions) where findings is a list of
+    (statement, flagged plan lines) and suggestions maps a table name to
+    proposed index column tuples not covered by an existing index.
+    """
+    findings = []
+    suggestions = {}
+    for statement, parameters in statements.items():
+        plan = explain_query_plan(statement, parameters)
+        flagged = [line for line in plan
+                   if (line.startswith('SCAN ') and ' USING ' not in line)
+                   or 'USE TEMP B-TREE' in line]
+        if not flagged:
+            continue
+        findings.append((statement, flagged))
+
+        tables = set()
+        for line in flagged:
+            if line.startswith('SCAN '):
+                tables.add(line.split()[1].strip('"'))
+            elif order_by := ORDER_BY_RE.search(statement):
+                tables.update(table for table, _ in COLUMN_RE.findall(order_by.group(1)))
+        for table in tables:
+            columns = suggest_index(statement, table)
+            if not columns or is_indexed(table, columns):
+                continue
+            if columns not in suggestions.setdefault(table, []):
+                suggestions[table].append(columns)
+    return findings, suggestions
+
+def is_indexed(table, columns):
+    """Check if an existing index on table starts with the given columns.
+
+    On small tables SQLite may still prefer a scan over such an index,
+    so it is not worth suggesting again.
+    """
+    if table not in db.metadata.tables:
+        return False
+    for index in db.inspect(db.engine).get_indexes(table):
+        if tuple(index['column_names'][:len(columns)]) == columns:
+            return True
+    return False
+
+def constant_default(column):
+    """Return column's default as a SQL literal, or None if it has no constant default"""
+    server_default = column.server_default
+    if server_default is not None:
+        if isinstance(server_default.arg, str):
+            return db.literal(server_default.arg).compile(
+                dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}).string
+        return None
+    if column.default is not None and column.default.is_scalar:
+        return db.literal(column.default.arg, column.type).compile(
+            dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}).string
+    return None
+
+def add_missing_columns():
+    """Add model columns that an existing database table lacks.
+
+    Constant defaults are written into the column so existing rows get them
+    too. Nullable columns with Python-side defaults are added plain, as the
+    ORM fills those in on insert. Columns SQLite cannot add, such as NOT
+    NULL ones without a constant default or ones with a SQL function
+    default, are skipped and returned as (added, skipped).
+    """
+    inspector = db.inspect(db.engine)
+    added, skipped = [], []
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            name = f'{table.name}.{column.name}'
+            default = constant_default(column)
+            if column.primary_key or (default is None and (not column.nullable or column.server_default is not None)):
+                skipped.append(name)
+                continue
+            ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.type.compile(db.engine.dialect)}'
+            if default is not None:
+                ddl += f' DEFAULT {default}'
+            if not column.nullable:
+                ddl += ' NOT NULL'
+            db.session.execute(db.text(ddl))
+            added.append(name)
+    db.session.commit()
+    return added, skipped
+
+def create_missing_indexes():
+    """Create every index declared on the models that the database lacks"""
+    existing = {row[0] for row in db.session.execute(
+        db.text("SELECT name FROM sqlite_master WHERE type = 'index'"))}
+    created = []
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine, checkfirst=True)
+                created.append(index.name)
+    return created
+
+@app.cli.command('query-advisor')
+@click.option('--user-id', type=int, help='Also replay logged-in pages as this user.')
+@click.option('--strict', is_flag=True, help='Exit with status 1 if any index is suggested (for CI).')
+def query_advisor_command(user_id, strict):
+    """Replay the app's pages and flag queries that scan or sort without an index."""
+    db.create_all()
+    statements = capture_select_statements(run_route_suite, user_id)
+    findings, suggestions = advise_indexes(statements)
+
+    click.echo(f"Checked {len(statements)} distinct SELECT statements, {len(findings)} flagged.")
+    for statement, flagged in findings:
+        click.echo('\n' + ' '.join(statement.split()))
+        for line in flagged:
+            click.echo(f"  -> {line}")
+
+    if suggestions:
+        click.echo('\nSuggested indexes:')
+        for table, indexes in sorted(suggestions.items()):
+            for columns in indexes:
+                name = f"ix_{table}_{'_'.join(columns)}"
+                click.echo(f'  CREATE INDEX IF NOT EXISTS {name} ON "{table}" ({", ".join(columns)});')
+        if strict:
+            raise SystemExit(1)
+
+def upgrade_database():
+    """Bring an existing database up to the current models.
+
+    Creates missing tables, columns and indexes, then fills in data derived
+    from existing rows for columns that were just added. Cheap when the
+    database is already current, so it runs on every startup.
+    Returns (added, skipped, created).
+    """
+    db.create_all()
+    added, skipped = add_missing_columns()
+    created = create_missing_indexes()
+    if {'user.geohash', 'product.geohash'} & set(added):
+        backfill_coordinates()
+    if 'category.product_count' in added or Product.query.filter(Product.category_id.is_(None)).first():
+        rebuild_category_tree()
+    if added or created:
+        db.session.execute(db.text('ANALYZE'))
+        db.session.commit()
+    return added, skipped, created
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Create missing tables, columns and indexes in an existing database."""
+    added, skipped, created = upgrade_database()
+    db.session.execute(db.text('ANALYZE'))
+    db.session.commit()
+    click.echo(f"Added {len(added)} columns: {', '.join(added) or 'none'}")
+    if skipped:
+        click.echo(f"Skipped {len(skipped)} columns that need a manual migration: {', '.join(skipped)}")
+    click.echo(f"Created {len(created)} indexes: {', '.join(created) or 'none'}")
+
+# ----------------- MAINTENANCE -----------------
+# Keeps the hot cart and order tables small. Meant to be run periodically,
+# e.g. from cron: flask --app app maintenance
+
+def purge_stale_carts(max_age_days):
+    """Delete carts untouched for max_age_days and merge duplicate cart rows.
+
+    A cart's age is its most recent add or quantity change. Rows from
+    before updated_date existed fall back to added_date.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=max_age_days)
+    touched = db.func.coalesce(CartItem.updated_date, CartItem.added_date)
+    stale_users = db.session.query(CartItem.user_id).group_by(CartItem.user_id) \
+        .having(db.func.max(touched) < cutoff)
+    purged = CartItem.query.filter(CartItem.user_id.in_(stale_users)).delete(synchronize_session=False)
+
+    duplicates = db.session.query(
+        CartItem.user_id, CartItem.product_id, db.func.min(CartItem.id),
+        db.func.sum(CartItem.quantity), db.func.max(touched)
+    ).group_by(CartItem.user_id, CartItem.product_id).having(db.func.count(CartItem.id) > 1).all()
+    merged = 0
+    for user_id, product_id, keep_id, quantity, updated_date in duplicates:
+        CartItem.query.filter_by(id=keep_id).update({'quantity': quantity, 'updated_date': updated_date})
+        merged += CartItem.query.filter(
+            CartItem.user_id == user_id,
+            CartItem.product_id == product_id,
+            CartItem.id != keep_id
+        ).delete(synchronize_session=False)
+    db.session.commit()
+    return purged, merged
+
+def archive_orders(older_than_days, statuses, batch_size=None):
+    """Move finished orders older than older_than_days to the archive table.
+
+    Orders are moved in id ranges of batch_size, each copied and deleted in
+    its own short transaction so checkouts are not locked out for the whole
+    run. The newest order is never archived so SQLite keeps handing out new
+    ids above the archived ones.
+    """
+    batch_size = batch_size or app.config['ORDER_ARCHIVE_BATCH_SIZE']
+    cutoff = datetime.now(timezone.utc) - timedelta(days=older_than_days)
+    first_id, last_id = db.session.query(db.func.min(Order.id), db.func.max(Order.id)).one()
+    if last_id is None:
+        return 0
+
+    orders = Order.__table__
+    columns = [column.name for column in orders.columns]
+    archived = 0
+    for low in range(first_id, last_id, batch_size):
+        condition = db.and_(
+            orders.c.id >= low,
+            orders.c.id < min(low + batch_size, last_id),
+            orders.c.created_date < cutoff,
+            orders.c.status.in_(statuses)
+        )
+        db.session.execute(db.insert(ArchivedOrder.__table__).from_select(
+            columns, db.select(*orders.columns).where(condition)))
+        archived += db.session.execute(db.delete(orders).where(condition)).rowcount
+        db.session.commit()
+    return archived
+
+def vacuum_database(pages):
+    """Return free pages to the filesystem and refresh planner statistics.
+
+    The first run switches the database to incremental auto-vacuum, which
+    needs one full VACUUM. Later runs free at most `pages` pages.
+    """
+    db.session.remove()
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        if connection.exec_driver_sql('PRAGMA auto_vacuum').scalar() != 2:
+            connection.exec_driver_sql('PRAGMA auto_vacuum = INCREMENTAL')
+            connection.exec_driver_sql('VACUUM')
+        else:
+            connection.exec_driver_sql(f'PRAGMA incremental_vacuum({int(pages)})')
+        connection.exec_driver_sql('ANALYZE')
+
+def get_order_history(user_id, limit=None):
+    """Get a user's orders newest first, reading through to the archive.
+
+    Checkout stamps every order of a basket with the same time, so ties
+    are broken by id to put the last one inserted first.
+    """
+    orders = []
+    for model in (Order, ArchivedOrder):
+        query = model.query.filter_by(user_id=user_id).order_by(model.created_date.desc(), model.id.desc())
+        if limit:
+            query = query.limit(limit)
+        orders += query.all()
+    orders.sort(key=lambda order: (order.created_date or datetime.min, order.id), reverse=True)
+    return orders[:limit] if limit else orders
+
+@app.cli.command('maintenance')
+@click.option('--cart-days', type=int, help='Purge carts untouched for this many days.')
+@click.option('--archive-days', type=int, help='Archive finished orders older than this many days.')
+@click.option('--no-vacuum', is_flag=True, help='Skip VACUUM and ANALYZE.')
+def maintenance_command(cart_days, archive_days, no_vacuum):
+    """Purge stale carts, archive old orders and vacuum the database."""
+    db.create_all()
+    purged, merged = purge_stale_carts(cart_days or app.config['CART_MAX_AGE_DAYS'])
+    click.echo(f"Purged {purged} stale cart items, merged {merged} duplicates.")
+
+    archived = archive_orders(archive_days or app.config['ORDER_ARCHIVE_AFTER_DAYS'],
+                              app.config['ORDER_ARCHIVE_STATUSES'])
+    click.echo(f"Archived {archived} orders.")
+
+    if not no_vacuum:
+        vacuum_database(app.config['INCREMENTAL_VACUUM_PAGES'])
+        click.echo("Vacuumed and analyzed database.")
+
 # ----------------- ROUTES -----------------
 @app.errorhandler(404)
 def not_found(error):
@@ -222,6 +1617,7 @@ def register():
             expertise=expertise,
             profile_picture=profile_picture
         )
+        set_coordinates(new_user, geocode(location))
 
         try:
             db.session.add(new_user)
@@ -257,6 +1653,17 @@ def login():
             session['user_id'] = user.id
             session['is_consultant'] = user.is_consultant
             session.permanent = True
+
+            # Merge a client-side guest cart, if one was posted with the form
+            guest_cart = request.form.get('guest_cart')
+            if guest_cart:
+                try:
+                    apply_cart_operations(user.id, json.loads(guest_cart), merge=True)
+                    db.session.commit()
+                except ValueError:
+                    db.session.rollback()
+                    flash("Some items from your guest cart could not be added.", "warning")
+
             flash("Login successful!", "success")
             
             next_page = request.args.get('next')
@@ -281,7 +1688,7 @@ def dashboard():
     try:
         user_products = Product.query.filter_by(user_id=user.id).all()
         user_posts = Post.query.filter_by(user_id=user.id).all()
-        user_orders = Order.query.filter_by(user_id=user.id).order_by(Order.created_date.desc()).limit(5).all()
+        user_orders = get_order_history(user.id, limit=5)
         return render_template('dashboard.html', user=user, products=user_products, posts=user_posts, orders=user_orders)
     except Exception as e:
         flash(f"Error loading dashboard: {str(e)}", "danger")
@@ -347,9 +1754,20 @@ def add_product():
             featured=featured,
             user_id=session['user_id']
         )
+        owner = User.query.get(session['user_id'])
+        if owner and owner.geohash:
+            set_coordinates(new_product, (owner.latitude, owner.longitude))
 
         try:
+            category_node = get_or_create_category(category)
+            if subcategory:
+                category_node = get_or_create_category(subcategory, category_node.id)
+            new_product.category_id = category_node.id
+
             db.session.add(new_product)
+            db.session.flush()
+            if new_product.active:
+                adjust_category_counts(new_product.category_id, products=1)
             db.session.commit()
             flash("Product added successfully!", "success")
             return redirect(url_for('products'))
@@ -366,28 +1784,48 @@ def products():
     try:
         category = request.args.get('category', '')
         search = request.args.get('search', '')
+        near = request.args.get('near', '')
+        radius = request.args.get('radius', type=float)
 
         query = Product.query.filter_by(active=True)
 
-        if category:
+        selected = resolve_category(category, 'product')
+        if selected:
+            category = selected.id
+            query = query.filter(db.or_(
+                Product.category_id.in_(category_descendants(selected.id)),
+                unlinked_products_in(selected)
+            ))
+        elif category:
             query = query.filter_by(category=category)
         if search:
             query = query.filter(Product.name.contains(search) | Product.description.contains(search))
 
-        all_products = query.all()
-        categories = db.session.query(Product.category).distinct().all()
+        distances = {}
+        results = search_near(query, Product, near, radius, request.args.get('nearest', type=int)) if near else None
+        if results is not None:
+            all_products = [product for product, _ in results]
+            distances = {product.id: distance for product, distance in results}
+        else:
+            if near:
+                flash(f"Could not find location '{near}'.", "warning")
+            all_products = query.all()
+        categories = category_tree('product')
 
-        return render_template('products.html', products=all_products, categories=categories, selected_category=category, search_query=search)
+        return render_template('products.html', products=all_products, categories=categories, selected_category=category, search_query=search,
+                               near=near, radius=radius or app.config['DEFAULT_SEARCH_RADIUS_KM'], distances=distances)
     except Exception as e:
         flash(f"Error loading products: {str(e)}", "danger")
-        return render_template('products.html', products=[], categories=[], selected_category='', search_query='')
+        return render_template('products.html', products=[], categories=[], selected_category='', search_query='',
+                               near='', radius=app.config['DEFAULT_SEARCH_RADIUS_KM'], distances={})
 
 # --- Product Detail ---
 @app.route('/product/<int:product_id>')
 def product_detail(product_id):
     try:
         product = Product.query.get_or_404(product_id)
-        return render_template('product_detail.html', product=product)
+        recommendations = get_recommendations(product_id)
+        return render_template('product_detail.html', product=product, recommendations=recommendations)
     except Exception as e:
         flash(f"Error loading product: {str(e)}", "danger")
         return redirect(url_for('products'))
@@ -417,54 +1855,74 @@ def new_forum_post():
             return redirect(url_for('new_forum_post'))
 
         tags = request.form.get('tags', '')
-        category_id = request.form.get('category_id')
-
-        try:
-            if category_id:
-                category_id = int(category_id)
-        except (ValueError, TypeError):
-            category_id = None
-
-        new_post = Post(
-            title=title,
-            content=content,
-            post_type='forum',
-            user_id=session['user_id'],
-            tags=tags,
-            category_id=category_id
-        )
+        # Knowledge articles are what the blog lists
+        post_type = 'blog' if request.form.get('post_type') == 'knowledge' else 'forum'
 
         try:
+            category = resolve_category(request.form.get('category_id', ''), 'post')
+            category_name = dict(POST_CATEGORIES).get(request.form.get('category'))
+            if category is None and category_name:
+                category = get_or_create_category(category_name, category_type='post')
+
+            new_post = Post(
+                title=title,
+                content=content,
+                post_type=post_type,
+                user_id=session['user_id'],
+                tags=tags,
+                category_id=category.id if category else None
+            )
             db.session.add(new_post)
+            if category and post_type == 'blog':
+                adjust_category_counts(category.id, posts=1)
             db.session.commit()
             flash("Post created successfully!", "success")
-            return redirect(url_for('forum'))
+            return redirect(url_for('blog' if post_type == 'blog' else 'forum'))
         except Exception as e:
             db.session.rollback()
             flash(f"Error creating post: {str(e)}", "danger")
             return redirect(url_for('new_forum_post'))
 
-    return render_template('new_post.html')
+    return render_template('new_post.html', post_categories=POST_CATEGORIES)
 
 # --- Blog ---
 @app.route('/blog')
 def blog():
     try:
-        posts = Post.query.filter_by(post_type='blog').order_by(Post.created_date.desc()).all()
-        return render_template('blog.html', posts=posts)
+        query = Post.query.filter_by(post_type='blog')
+        selected = resolve_category(request.args.get('category', ''), 'post')
+        if selected:
+            query = query.filter(Post.category_id.in_(category_descendants(selected.id)))
+        posts = query.order_by(Post.created_date.desc()).all()
+        categories = [category for category, depth in category_tree('post') if depth == 0]
+        return render_template('blog.html', posts=posts, categories=categories, selected_category=selected)
     except Exception as e:
         flash(f"Error loading blog: {str(e)}", "danger")
-        return render_template('blog.html', posts=[])
+        return render_template('blog.html', posts=[], categories=[], selected_category=None)
 
 # --- Consultancy Services ---
 @app.route('/consultants')
 def consultants():
     try:
-        consultants = User.query.filter_by(is_consultant=True, consultant_approved=True).all()
-        return render_template('consultants.html', consultants=consultants)
+        near = request.args.get('near', '')
+        radius = request.args.get('radius', type=float)
+        query = User.query.filter_by(is_consultant=True, consultant_approved=True)
+
+        distances = {}
+        results = search_near(query, User, near, radius, request.args.get('nearest', type=int)) if near else None
+        if results is not None:
+            consultants = [consultant for consultant, _ in results]
+            distances = {consultant.id: distance for consultant, distance in results}
+        else:
+            if near:
+                flash(f"Could not find location '{near}'.", "warning")
+            consultants = query.all()
+        return render_template('consultants.html', consultants=consultants, near=near,
+                               radius=radius or app.config['DEFAULT_SEARCH_RADIUS_KM'], distances=distances)
     except Exception as e:
         flash(f"Error loading consultants: {str(e)}", "danger")
-        return render_template('consultants.html', consultants=[])
+        return render_template('consultants.html', consultants=[], near='',
+                               radius=app.config['DEFAULT_SEARCH_RADIUS_KM'], distances={})
 
 @app.route('/become_consultant', methods=['GET', 'POST'])
 def become_consultant():
@@ -627,19 +2085,49 @@ def update_cart(product_id):
             else:
                 cart_item.quantity = quantity
             db.session.commit()
-            
-        cart_items = get_cart_items(session['user_id'])
-        total = get_cart_total(session['user_id'])
-        
+
+        total, item_count = get_cart_summary(session['user_id'])
+
         return jsonify({
-            'success': True, 
+            'success': True,
             'total': total,
-            'item_count': len(cart_items)
+            'item_count': item_count
         })
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/cart/batch', methods=['POST'])
+def update_cart_batch():
+    """Apply several cart changes in one transaction.
+
+    Expects JSON like {"items": [{"product_id": 1, "quantity": 2}, ...]}.
+    Pass "merge": true to add quantities instead of replacing them.
+    """
+    if 'user' not in session:
+        return jsonify({'error': 'Please login'}), 401
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object with an items list.'}), 400
+
+    try:
+        apply_cart_operations(session['user_id'], data.get('items'), merge=bool(data.get('merge')))
+        db.session.commit()
+
+        total, item_count = get_cart_summary(session['user_id'])
+        return jsonify({
+            'success': True,
+            'total': total,
+            'item_count': item_count
+        })
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/cart/remove/<int:product_id>')
 def remove_from_cart(product_id):
     if 'user' not in session:
@@ -693,7 +2181,9 @@ def checkout():
                     flash(f"Not enough stock for {cart_item.product.name}. Only {cart_item.product.stock_quantity} available.", "danger")
                     return redirect(url_for('cart'))
             
-            # Create orders for each cart item
+            # Create orders for each cart item, stamped with one time so
+            # the checkout can be recognised as a basket later
+            placed_at = datetime.now(timezone.utc)
             for cart_item in cart_items:
                 # Create order
                 order = Order(
@@ -702,13 +2192,16 @@ def checkout():
                     quantity=cart_item.quantity,
                     total_price=cart_item.product.price * cart_item.quantity,
                     shipping_address=shipping_address,
-                    status='confirmed'
+                    status='confirmed',
+                    created_date=placed_at
                 )
                 db.session.add(order)
                 
                 # Update product stock
                 cart_item.product.stock_quantity -= cart_item.quantity
             
+            record_co_purchases([cart_item.product_id for cart_item in cart_items])
+
             # Clear cart after successful order
             clear_cart(session['user_id'])
             db.session.commit()
@@ -729,7 +2222,8 @@ def order_confirmation():
         return redirect(url_for('login'))
     
     # Get the latest order for confirmation
-    latest_order = Order.query.filter_by(user_id=session['user_id']).order_by(Order.created_date.desc()).first()
+    latest_orders = get_order_history(session['user_id'], limit=1)
+    latest_order = latest_orders[0] if latest_orders else None
     if not latest_order:
         flash("No recent orders found.", "warning")
         return redirect(url_for('user_orders'))
@@ -742,12 +2236,31 @@ def user_orders():
         return redirect(url_for('login'))
     
     try:
-        orders = Order.query.filter_by(user_id=session['user_id']).order_by(Order.created_date.desc()).all()
+        orders = get_order_history(session['user_id'])
         return render_template('orders.html', orders=orders)
     except Exception as e:
         flash(f"Error loading orders: {str(e)}", "danger")
         return render_template('orders.html', orders=[])
 
+# --- Admin Reports ---
+@app.route('/admin/reports/sales')
+def admin_sales_report():
+    if not is_admin():
+        return jsonify({'error': 'Admin access required'}), 403
+
+    try:
+        report = sales_report(
+            bucket=request.args.get('bucket', 'week'),
+            top=request.args.get('top', 10, type=int),
+            start=parse_report_date(request.args.get('start')),
+            end=parse_report_date(request.args.get('end'))
+        )
+        return jsonify(report)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 # --- Password Reset ---
 @app.route('/reset_request', methods=['GET', 'POST'])
 def reset_request():
@@ -816,5 +2329,5 @@ def reset_password(token):
 # ----------------- MAIN -----------------
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        upgrade_database()
     app.run(debug=True)
\ No newline at end of file